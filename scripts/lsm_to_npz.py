@@ -5,13 +5,16 @@ lsm_to_npz_v4.py
 ----------------
 Convert Zeiss .LSM (and optionally .TIF/.TIFF) confocal stacks into a browser-friendly
 NPZ bundle for the HTML viewer. The NPZ contains:
-  - r.npy, g.npy, b.npy  (float32 arrays, shape Z×Y×X, C-order, values in [0, 1])
-  - meta.json            (voxel sizes, downsample factor, background sigma, channel map, filename)
+  - rgb.npy    (shape Z×Y×X×3, C-order, channels interleaved as R,G,B per voxel;
+                uint8 0–255 by default, or float32 in [0, 1] with --dtype float32)
+  - meta.json  (voxel sizes, downsample factor, background sigma, channel map, filename,
+                dtype, the scale that maps stored values back to [0, 1], and layout)
 
 Processing pipeline (per channel):
-  1) Gaussian background subtraction (σ = --sigma pixels; set 0 to disable)
-  2) Robust percentile normalization to [0,1] (0.5–99.5th percentile)
-  3) XY downsampling by an integer factor (--ds), Z unchanged
+  1) XY downsampling by an integer factor (--ds, mean of ds×ds blocks), Z unchanged
+  2) Gaussian background subtraction (σ = --sigma full-resolution pixels; set 0 to disable)
+  3) Robust percentile normalization to [0,1] (0.5–99.5th percentile; --no-normalize
+     divides by the brightest raw value of the mapped channels instead)
 
 Channel mapping:
   Use --map R,G,B to pick which input channel index becomes R, G, and B.
@@ -37,46 +40,384 @@ Author: you :)
 License: MIT
 """
 
-import sys, os, json, zipfile, io, argparse
+import sys, os, io, json, zipfile, argparse, multiprocessing
+from contextlib import nullcontext
+from functools import lru_cache
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import tifffile
-from scipy.ndimage import gaussian_filter
-from numpy.lib.format import write_array
+from scipy.ndimage import gaussian_filter1d
+from scipy.fft import dctn, idctn
+from numpy.lib.format import write_array_header_1_0, dtype_to_descr
+
+try:  # optional: fused single-pass kernels
+    from numba import njit, prange, set_num_threads, config as numba_config
+except ImportError:
+    njit = None
 
 
 # ---------------------------- Image preprocessing --------------------------------
 
-def normalize(img, lo=0.5, hi=99.5):
+# From this sigma up, the background blur is done in the frequency domain: the
+# separable spatial kernel has ~8·sigma taps per axis, while the transform costs
+# O(log N) per pixel regardless of sigma.
+FFT_MIN_SIGMA = 4.0
+
+# Background subtraction in float32 leaves round-off of about this size relative to
+# the slice's peak value (e.g. the DCT blur of a constant slice). After the step, a
+# percentile spread below FLAT_RTOL × peak is only that residue: treat as flat.
+FLAT_RTOL = 1e-5
+
+# Per-thread working-set budget (≈ a core's share of L3). Channels are processed
+# in Z chunks of this size so blur, subtraction, normalization and quantization
+# all run while the chunk is still in cache instead of streaming the whole
+# volume from DRAM once per step.
+CACHE_BYTES = 4 << 20
+
+# Largest per-slice value range percentile_bounds handles with a histogram (all of
+# 16-bit); wider integer data (e.g. int32 TIFFs) is selected like floats instead.
+HIST_MAX_BINS = 1 << 16
+
+
+def gaussian_kernel_dct(Y, X, sigma):
+    """
+    Gaussian transfer function on the DCT-II frequency grid of a Y×X slice.
+    DCT-II implies half-sample symmetric boundaries, i.e. the same 'reflect' mode
+    as scipy.ndimage, so multiplying DCT coefficients by this kernel reproduces
+    gaussian_filter up to the ndimage kernel truncation. Returns float32 Y×X.
+    """
+    ky = np.exp(-0.5 * (np.pi * sigma * np.arange(Y) / Y) ** 2)
+    kx = np.exp(-0.5 * (np.pi * sigma * np.arange(X) / X) ** 2)
+    return (ky[:, None] * kx[None, :]).astype(np.float32)
+
+
+def percentile_bounds(stack, lo=0.5, hi=99.5):
     """
-    Percentile-based normalization to [0,1].
-    lo, hi are percentiles (float). Robust to outliers.
+    Exact lo/hi percentiles of every Z slice (same values as np.percentile with its
+    default linear interpolation), found by selection rather than sorting.
+    Integer stacks of at most HIST_MAX_BINS distinct levels per slice (raw detector
+    counts) use a histogram with one bin per value; anything else uses introselect
+    (np.partition) on a private copy. Both are O(N).
+    Returns two float32 arrays of length Z.
     """
-    lo_v, hi_v = np.percentile(img, [lo, hi])
-    if hi_v == lo_v:
-        return np.zeros_like(img, dtype=np.float32)
-    x = (img.astype(np.float32) - lo_v) / (hi_v - lo_v)
-    return np.clip(x, 0, 1)
+    Z = stack.shape[0]
+    flat = stack.reshape(Z, -1)
+    n = flat.shape[1]
+    ranks = [p / 100.0 * (n - 1) for p in (lo, hi)]
+    # Order statistics needed: each rank's floor and its right neighbour
+    ks = sorted({min(int(r) + d, n - 1) for r in ranks for d in (0, 1)})
+
+    bins = None
+    if np.issubdtype(flat.dtype, np.integer):
+        mn, mx = flat.min(axis=1), flat.max(axis=1)
+        # Python ints, so wide types (int32 spans, uint64) cannot overflow
+        bins = max(int(b) - int(a) for a, b in zip(mn, mx)) + 1
+
+    if bins is not None and bins <= HIST_MAX_BINS:
+        # Bin index of every pixel, offset by slice so one bincount covers all slices
+        mn = mn.astype(np.int64)
+        idx = np.subtract(flat, mn[:, None], dtype=np.intp)
+        idx += (np.arange(Z, dtype=np.intp) * bins)[:, None]
+        hist = np.bincount(idx.ravel(), minlength=Z * bins).reshape(Z, bins)
+        del idx
+
+        # Offset each slice's CDF by z*n so the concatenation is monotone for searchsorted
+        cdf = np.cumsum(hist, axis=1)
+        cdf += (np.arange(Z, dtype=cdf.dtype) * n)[:, None]
+        cdf = cdf.ravel()
+        base = np.arange(Z) * n
+        kth = {k: mn + np.searchsorted(cdf, base + k, side="right") - np.arange(Z) * bins
+               for k in ks}
+    else:
+        part = np.array(flat, copy=True)   # partitioned in place; stack keeps its layout
+        part.partition(ks, axis=1)
+        kth = {k: part[:, k] for k in ks}
+
+    out = []
+    for rank in ranks:
+        r0 = int(rank)
+        v0 = kth[r0].astype(np.float64)
+        v1 = kth[min(r0 + 1, n - 1)].astype(np.float64)
+        out.append((v0 + (rank - r0) * (v1 - v0)).astype(np.float32))
+    return out[0], out[1]
+
+
+if njit is not None:
+    @njit(nogil=True, fastmath=True, cache=True)
+    def _fused_norm(stack, lo_v, hi_v, tol_v, out):
+        """(x − lo)/(hi − lo) clipped to [0,1] in one pass; flat slices become 0."""
+        Z, Y, X = stack.shape
+        for z in range(Z):
+            lo = lo_v[z]
+            d = hi_v[z] - lo
+            inv = np.float32(1.0) / d if d > tol_v[z] else np.float32(0.0)
+            for y in range(Y):
+                for x in range(X):
+                    v = (np.float32(stack[z, y, x]) - lo) * inv
+                    out[z, y, x] = 0.0 if v < 0.0 else (1.0 if v > 1.0 else v)
+else:
+    _fused_norm = None
+
+
+def normalize(stack, lo=0.5, hi=99.5, out=None, atol=0.0):
+    """
+    Percentile-based normalization to [0,1], per Z slice.
+    stack is a Z×Y×X array of any real dtype; lo, hi are percentiles (float). Robust
+    to outliers. The float32 result goes to `out` (allocated if None; may be `stack`).
+    Slices with no dynamic range (hi − lo ≤ atol, a scalar or one value per slice)
+    become all zeros.
+    Uses a fused numba kernel when numba is installed, NumPy otherwise.
+    """
+    if out is None:
+        out = np.empty(stack.shape, dtype=np.float32)
+    lo_v, hi_v = percentile_bounds(stack, lo, hi)
+    tol_v = np.broadcast_to(np.asarray(atol, dtype=np.float32), lo_v.shape)
+    if _fused_norm is not None:
+        _fused_norm(stack, lo_v, hi_v, np.ascontiguousarray(tol_v), out)
+        return out
+    # Flat slices get a zero gain, so they come out as 0 without a masked write
+    spread = hi_v - lo_v
+    gain = np.zeros_like(spread)
+    np.divide(1, spread, out=gain, where=spread > tol_v)
+    np.subtract(stack, lo_v[:, None, None], out=out)
+    out *= gain[:, None, None]
+    np.clip(out, 0, 1, out=out)  # single SIMD ufunc pass
+    return out
 
 
-def subtract_bg(img, sigma=12):
+def subtract_bg(src, sigma=12, out=None, scratch=None, kernel=None, workers=-1):
     """
     Estimate background via Gaussian blur (sigma in pixels), subtract, and floor at 0.
+    src is a Z×Y×X array of any real dtype; each Z slice is blurred on its own (no
+    smoothing along Z) with two separable 1-D passes. The float32 result goes to `out`
+    (allocated if None; may be `src` itself); `scratch` is an optional float32 buffer of
+    the same shape for the blurred background, so callers can reuse it across channels.
+    If `kernel` (from gaussian_kernel_dct) is given, the blur is done with a DCT instead,
+    using `workers` threads (-1 = all cores).
     Set sigma=0 to disable subtraction.
     """
-    if sigma and sigma > 0:
-        bg = gaussian_filter(img.astype(np.float32), sigma=sigma)
-        out = img.astype(np.float32) - bg
-        out[out < 0] = 0
-        return out
-    return img.astype(np.float32)
+    if out is None:
+        out = np.empty(src.shape, dtype=np.float32)
+    if kernel is not None:
+        out[...] = src
+        coef = dctn(out, axes=(1, 2), norm="ortho", workers=workers)
+        coef *= kernel
+        bg = idctn(coef, axes=(1, 2), norm="ortho", overwrite_x=True, workers=workers)
+        np.subtract(out, bg, out=out)
+        np.maximum(out, 0, out=out)
+    elif sigma and sigma > 0:
+        if scratch is None:
+            scratch = np.empty(src.shape, dtype=np.float32)
+        gaussian_filter1d(src, sigma, axis=2, output=scratch)
+        gaussian_filter1d(scratch, sigma, axis=1, output=scratch)
+        np.subtract(src, scratch, out=out)
+        np.maximum(out, 0, out=out)
+    else:
+        out[...] = src
+    return out
+
+
+def downsample_mean(stack, ds):
+    """
+    XY downsampling of a Z×Y×X array by averaging ds×ds blocks (Z unchanged).
+    Y and X are cropped to multiples of ds. Returns float32 Z×(Y//ds)×(X//ds);
+    with ds == 1 the input is returned as is (no copy, original dtype).
+    """
+    if ds == 1:
+        return stack
+    Z, Y, X = stack.shape
+    Yd, Xd = Y // ds, X // ds
+    blocks = stack[:, :Yd * ds, :Xd * ds].reshape(Z, Yd, ds, Xd, ds)
+    return blocks.mean(axis=(2, 4), dtype=np.float32)
+
+
+def store_unit(stack, out):
+    """
+    Write float32 values in [0,1] into `out`: round(v·255) if out is uint8, v as is
+    otherwise. `out` may be a strided view (e.g. one channel of an interleaved array);
+    `stack` is used as scratch and overwritten.
+    """
+    if out.dtype == np.uint8:
+        # Round and cast straight into out: no separate copy pass after the +0.5
+        np.multiply(stack, 255, out=stack)
+        np.add(stack, 0.5, out=out, casting="unsafe")
+    else:
+        out[...] = stack
+    return out
+
+
+@lru_cache(maxsize=None)
+def gaussian_weights(sigma, truncate=4.0):
+    """
+    Normalized 1-D Gaussian taps, identical to scipy.ndimage.gaussian_filter1d's
+    (radius = int(truncate·sigma + 0.5)). Empty for sigma == 0 (no background step).
+    """
+    if not sigma:
+        return np.zeros(0)
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    phi = np.exp(-0.5 * (x / sigma) ** 2)
+    return phi / phi.sum()
+
+
+if njit is not None:
+    @njit(inline="always")
+    def _reflect(i, n):
+        """scipy.ndimage 'reflect' boundary: index i folded into [0, n)."""
+        i = i % (2 * n)
+        return 2 * n - 1 - i if i >= n else i
+
+    @njit(fastmath=True, cache=True)
+    def _select(a, k, lo, hi):
+        """Quickselect in place: afterwards a[lo:k] <= a[k] <= a[k+1:hi+1]."""
+        while hi > lo:
+            mid = (lo + hi) >> 1
+            x, y, z = a[lo], a[mid], a[hi]     # median-of-three pivot
+            if x > y:
+                x, y = y, x
+            if y > z:
+                y = z
+            if x > y:
+                y = x
+            i, j = lo, hi
+            while i <= j:
+                while a[i] < y:
+                    i += 1
+                while a[j] > y:
+                    j -= 1
+                if i <= j:
+                    a[i], a[j] = a[j], a[i]
+                    i += 1
+                    j -= 1
+            if k <= j:
+                hi = j
+            elif k >= i:
+                lo = i
+            else:
+                return
+
+    @njit(fastmath=True, cache=True)
+    def _percentile_pair(buf, p0, p1):
+        """
+        Exact p0 <= p1 percentiles of buf (reordered in place), with np.percentile's
+        linear interpolation. The higher rank is selected first so the lower one
+        only has to search the part below it.
+        """
+        n = buf.shape[0]
+        r1 = p1 / 100.0 * (n - 1)
+        k1 = int(r1)
+        _select(buf, k1, 0, n - 1)
+        a1 = b1 = buf[k1]
+        if k1 + 1 < n:
+            b1 = buf[k1 + 1:].min()
+        r0 = p0 / 100.0 * (n - 1)
+        k0 = int(r0)
+        _select(buf, k0, 0, k1)
+        a0 = buf[k0]
+        b0 = buf[k0 + 1:k1 + 1].min() if k0 < k1 else b1
+        return a0 + (r0 - k0) * (b0 - a0), a1 + (r1 - k1) * (b1 - a1)
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _fused_preprocess(vol, chans, z0, z1, ds, weights, lo_p, hi_p, qscale, qoff, out):
+        """
+        Whole per-slice pipeline in one kernel, parallel over (slice, channel):
+        ds×ds block mean of vol[z, chans[c]] (Z×C×Y×X), separable Gaussian background
+        (taps `weights`, reflect boundary) subtracted and floored at 0, exact lo_p/hi_p
+        percentiles, normalization to [0,1], and v·qscale + qoff stored to out[z, :, :, c].
+        Each task keeps its slice in a few small buffers instead of making ~6 passes
+        over the volume.
+        """
+        Yd = vol.shape[2] // ds
+        Xd = vol.shape[3] // ds
+        nc = chans.shape[0]
+        nw = weights.shape[0]
+        r = (nw - 1) // 2
+        w = weights.astype(np.float32)
+        inv_area = np.float32(1.0 / (ds * ds))
+        rtol = np.float32(FLAT_RTOL)
+        for t in prange((z1 - z0) * nc):
+            z = t // nc
+            c = t % nc
+            src = vol[z0 + z, chans[c]]
+
+            img = np.zeros((Yd, Xd), dtype=np.float32)
+            for y in range(Yd):
+                for dy in range(ds):
+                    row = src[y * ds + dy]
+                    for x in range(Xd):
+                        acc = np.float32(0.0)
+                        for dx in range(ds):
+                            acc += row[x * ds + dx]
+                        img[y, x] += acc
+                for x in range(Xd):
+                    img[y, x] *= inv_area
+
+            tol = np.float32(0.0)
+            if nw > 0:
+                tol = rtol * np.abs(img).max()
+                # X pass over a reflect-padded copy of each row
+                tmp = np.empty((Yd, Xd), dtype=np.float32)
+                pad = np.empty(Xd + 2 * r, dtype=np.float32)
+                for y in range(Yd):
+                    for i in range(Xd + 2 * r):
+                        pad[i] = img[y, _reflect(i - r, Xd)]
+                    for x in range(Xd):
+                        acc = np.float32(0.0)
+                        for j in range(nw):
+                            acc += w[j] * pad[x + j]
+                        tmp[y, x] = acc
+                # Y pass accumulated row-wise, then subtract and floor at 0
+                bg = np.empty(Xd, dtype=np.float32)
+                for y in range(Yd):
+                    bg[:] = 0.0
+                    for j in range(nw):
+                        yy = _reflect(y + j - r, Yd)
+                        for x in range(Xd):
+                            bg[x] += w[j] * tmp[yy, x]
+                    for x in range(Xd):
+                        v = img[y, x] - bg[x]
+                        img[y, x] = v if v > 0.0 else 0.0
+
+            lo, hi = _percentile_pair(img.ravel().copy(), lo_p, hi_p)
+            d = hi - lo
+            inv = 1.0 / d if d > tol else 0.0
+            for y in range(Yd):
+                for x in range(Xd):
+                    v = (img[y, x] - lo) * inv
+                    v = 0.0 if v < 0.0 else (1.0 if v > 1.0 else v)
+                    out[z, y, x, c] = v * qscale + qoff
+else:
+    _fused_preprocess = None
+
+
+# ---------------------------- NPY output -----------------------------------------
+
+@lru_cache(maxsize=None)
+def npy_header(shape, dtype):
+    """
+    Serialized NPY v1.0 header (magic, length, padded dict) for a C-order array of
+    the given shape and dtype. It only depends on shape/dtype, so it is built once
+    and reused, e.g. across same-sized stacks in a batch.
+    """
+    bio = io.BytesIO()
+    write_array_header_1_0(bio, {"descr": dtype_to_descr(np.dtype(dtype)),
+                                 "fortran_order": False,
+                                 "shape": tuple(shape)})
+    return bio.getvalue()
 
 
 # ---------------------------- Core conversion logic ------------------------------
 
-def convert_one(in_path: Path, out_npz: Path, ds=6, sigma=12, ch_map=(2, 0, 1)):
+def convert_one(in_path: Path, out_npz: Path, ds=6, sigma=12, ch_map=(2, 0, 1), threads=None,
+                dtype="uint8", zlevel=1, percentile_norm=True):
     """
-    Convert a single LSM/TIFF to NPZ with r.npy, g.npy, b.npy and meta.json.
+    Convert a single LSM/TIFF to NPZ with an interleaved rgb.npy and meta.json.
+    threads: CPU threads this conversion may use (default: all cores).
+    dtype: "uint8" stores round(v·255) per voxel (meta scale = 1/255), "float32" stores v as is.
+    zlevel: DEFLATE level 1–9 for the NPZ members, or 0 to store them uncompressed.
+    percentile_norm: if False, skip the percentile normalization and divide by the
+      maximum raw value over the mapped channels instead (stored as meta "input_max").
 
     Assumptions:
       - tif.series[0] is the main 4D array with axes Z,C,Y,X (typical for LSM).
@@ -85,7 +426,9 @@ def convert_one(in_path: Path, out_npz: Path, ds=6, sigma=12, ch_map=(2, 0, 1)):
 
     with tifffile.TiffFile(str(in_path)) as tif:
         series = tif.series[0]
-        vol = series.asarray()             # expected shape: (Z, C, Y, X)
+        # Decode into a temporary memory-mapped file rather than RAM: each channel
+        # is read once, so pages fault in on demand and can be evicted again.
+        vol = series.asarray(out="memmap")  # expected shape: (Z, C, Y, X)
         meta = getattr(tif, "lsm_metadata", {}) or {}
 
     if vol.ndim != 4:
@@ -94,26 +437,100 @@ def convert_one(in_path: Path, out_npz: Path, ds=6, sigma=12, ch_map=(2, 0, 1)):
     Z, C, Y, X = vol.shape
     if C < 3:
         raise ValueError(f"{in_path.name}: need 3 channels (got {C}).")
+    if not 1 <= ds <= min(Y, X):
+        raise ValueError(f"{in_path.name}: ds must be between 1 and {min(Y, X)} "
+                         f"for a {Y}×{X} stack (got {ds}).")
+    # Checked up front: the numba kernel indexes channels without bounds checks
+    if max(ch_map) >= C:
+        raise ValueError(f"{in_path.name}: channel map {list(ch_map)} out of range "
+                         f"for {C} channels (indices 0–{C - 1}).")
 
     # Physical voxel sizes (meters in LSM → micrometers)
     vx_um = float(meta.get("VoxelSizeX", 1.0)) * 1e6
     vy_um = float(meta.get("VoxelSizeY", 1.0)) * 1e6
     vz_um = float(meta.get("VoxelSizeZ", 1.0)) * 1e6
 
-    def clean(ch):
+    # DCT background kernel for large sigma, shared read-only by all channels
+    # Background is estimated on the downsampled grid, where sigma shrinks by ds
+    sigma_ds = sigma / ds
+    kernel = None
+    if sigma_ds and sigma_ds >= FFT_MIN_SIGMA:
+        kernel = gaussian_kernel_dct(Y // ds, X // ds, sigma_ds)
+
+    # Channels run concurrently (NumPy/SciPy release the GIL), so split the
+    # cores between them rather than letting each DCT grab all of them
+    fft_workers = max(1, (threads or os.cpu_count() or 1) // len(ch_map))
+
+    # Fixed scale used instead of percentiles with --no-normalize: the brightest raw
+    # value over the mapped channels. The type's maximum would not do, since LSMs
+    # usually hold 12-bit data in uint16. One scale for all channels and slices keeps
+    # their relative intensities.
+    full_range = 1.0
+    if not percentile_norm:
+        full_range = max(float(vol[:, ch].max()) for ch in set(ch_map)) or 1.0
+
+    def clean(ch, z0, z1):
         """
-        Apply background subtraction and normalization per Z slice, then
-        downsample in X/Y by factor ds. Return float32 Z×Y×X in [0,1].
+        Downsample slices z0:z1 of channel ch in X/Y by factor ds (block mean), then
+        apply background subtraction and normalization per Z slice. Return float32
+        (z1−z0)×Y×X in [0,1]. Every step is per slice, so chunks are independent.
+        Safe to run from several threads: all buffers are private to the call.
+        With ds == 1 and no background step the raw integer counts go straight to
+        normalize(), whose histogram is then exact and needs no float copy first.
         """
-        stack = np.stack([subtract_bg(vol[z, ch], sigma) for z in range(Z)], axis=0)
-        stack = np.stack([normalize(stack[z]) for z in range(Z)], axis=0)
-        return stack[:, ::ds, ::ds].astype('float32', copy=False)
-
-    # Channel mapping: output R,G,B are selected source-channel indices
-    src_for_r, src_for_g, src_for_b = ch_map
-    r = clean(src_for_r)
-    g = clean(src_for_g)
-    b = clean(src_for_b)
+        stack = downsample_mean(vol[z0:z1, ch], ds)
+        owned = ds > 1                  # stack is our own float32 buffer, not a view of vol
+        atol = 0.0
+        if sigma:
+            # Flat-slice tolerance scales with each slice's peak before subtraction
+            atol = FLAT_RTOL * np.maximum(np.abs(stack.max(axis=(1, 2)).astype(np.float32)),
+                                          np.abs(stack.min(axis=(1, 2)).astype(np.float32)))
+            stack = subtract_bg(stack, sigma_ds, out=stack if owned else None,
+                                kernel=kernel, workers=fft_workers)
+            owned = True
+        out = stack if owned else None
+        if percentile_norm:
+            return normalize(stack, out=out, atol=atol)
+        if out is None:
+            out = np.empty(stack.shape, dtype=np.float32)
+        np.multiply(stack, 1.0 / full_range, out=out)
+        return np.clip(out, 0, 1, out=out)
+
+    # Output volume, Z×Y×X×3 with R,G,B interleaved per voxel, produced in Z chunks
+    # sized so a chunk's float32 stack plus blur scratch fit in CACHE_BYTES
+    shape = (Z, Y // ds, X // ds, 3)
+    cz = max(1, CACHE_BYTES // (2 * 4 * shape[1] * shape[2]))
+
+    # With numba, the common case (percentile normalization, spatial background)
+    # runs as one fused kernel per chunk, parallel over slices and channels.
+    # Without pooling or blur there is nothing to fuse and NumPy is faster.
+    weights = gaussian_weights(float(sigma_ds))
+    fused = (_fused_preprocess is not None and percentile_norm and kernel is None
+             and (ds > 1 or weights.size > 0))
+    if fused:
+        nthreads = max(1, min(threads or os.cpu_count() or 1, numba_config.NUMBA_NUM_THREADS))
+        set_num_threads(nthreads)
+        # Each kernel task holds a single slice, so CACHE_BYTES is a per-thread budget
+        # here: scale the chunk by the thread count so every launch has at least 3 tasks
+        # (slices × channels) per thread and the fork/join runs once per nthreads chunks
+        cz *= nthreads
+        chans = np.asarray(ch_map, dtype=np.intp)
+        raw = np.asarray(vol)               # plain ndarray view of the memmap for numba
+        qscale, qoff = (255.0, 0.5) if dtype == "uint8" else (1.0, 0.0)
+
+    def process(z0, z1, ex):
+        """Compute slices z0:z1 of the output; the channels run on ex concurrently."""
+        slab = np.empty((z1 - z0,) + shape[1:], dtype=dtype)
+        if fused:
+            _fused_preprocess(raw, chans, z0, z1, ds, weights, 0.5, 99.5, qscale, qoff, slab)
+            return slab
+
+        def fill(i):
+            # Channel mapping: output R,G,B are selected source-channel indices
+            store_unit(clean(ch_map[i], z0, z1), slab[..., i])
+
+        list(ex.map(fill, range(3)))
+        return slab
 
     # Metadata bundled into NPZ
     meta_out = {
@@ -123,25 +540,59 @@ def convert_one(in_path: Path, out_npz: Path, ds=6, sigma=12, ch_map=(2, 0, 1)):
         "ds": int(ds),
         "sigma": float(sigma),
         "file": in_path.name,
-        "channel_map": list(map(int, ch_map))
+        "channel_map": list(map(int, ch_map)),
+        "dtype": dtype,
+        "scale": 1 / 255 if dtype == "uint8" else 1.0,
+        "normalized": bool(percentile_norm),
+        "input_max": full_range if not percentile_norm else None,
+        "layout": "interleaved"
     }
 
-    # Write standard NPZ with NPY v1.0 members (so the browser parser stays simple)
+    # Write standard NPZ with NPY v1.0 members (so the browser parser stays simple).
+    # Only STORED/DEFLATE are used: they are all the viewer's unzip (fflate) can read.
     out_npz.parent.mkdir(parents=True, exist_ok=True)
-    with zipfile.ZipFile(str(out_npz), "w", compression=zipfile.ZIP_DEFLATED) as zf:
-
-        def write_npy(arcname, arr):
-            bio = io.BytesIO()
-            arr_c = np.ascontiguousarray(arr, dtype=np.float32)
-            write_array(bio, arr_c, version=(1, 0))  # NPY v1.0 header
-            zf.writestr(arcname, bio.getvalue())
-
-        write_npy("r.npy", r)
-        write_npy("g.npy", g)
-        write_npy("b.npy", b)
-        zf.writestr("meta.json", json.dumps(meta_out).encode("utf-8"))
-
-    print(f"[OK] {in_path.name} -> {out_npz.name}  |  Z×Y×X={tuple(r.shape)}  |  "
+    if zlevel:
+        compression, compresslevel = zipfile.ZIP_DEFLATED, int(zlevel)
+    else:
+        compression, compresslevel = zipfile.ZIP_STORED, None
+    # Written under a temporary name and moved into place only once complete, so a
+    # failure mid-stream leaves no truncated NPZ (and keeps any previous one intact)
+    tmp_npz = partial_path(out_npz)
+    try:
+        with zipfile.ZipFile(str(tmp_npz), "w", compression=compression,
+                             compresslevel=compresslevel) as zf:
+
+            def write_slab(fh, arr):
+                # Slabs from process() are already C-contiguous in the output dtype, so the
+                # normal path hands their buffer to the zip as is
+                if arr.dtype != dtype or not arr.flags["C_CONTIGUOUS"]:
+                    arr = np.ascontiguousarray(arr, dtype=dtype)
+                fh.write(arr.reshape(-1).view(np.uint8))
+
+            # rgb.npy is streamed: the header only depends on the shape, so it goes first,
+            # then each finished Z chunk is handed to a single writer thread (ZipFile is not
+            # thread-safe) which CRCs/compresses it while the next chunk is being computed.
+            # At most one write is in flight, which bounds memory to about two chunks.
+            with zf.open("rgb.npy", mode="w", force_zip64=True) as fh, \
+                    ThreadPoolExecutor(max_workers=len(ch_map)) as ex, \
+                    ThreadPoolExecutor(max_workers=1) as writer:
+                fh.write(npy_header(shape, np.dtype(dtype).str))
+                pending = None
+                for z0 in range(0, Z, cz):
+                    slab = process(z0, min(z0 + cz, Z), ex)
+                    if pending is not None:
+                        pending.result()
+                    pending = writer.submit(write_slab, fh, slab)
+                if pending is not None:
+                    pending.result()
+
+            zf.writestr("meta.json", json.dumps(meta_out).encode("utf-8"))
+    except BaseException:
+        tmp_npz.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_npz, out_npz)
+
+    print(f"[OK] {in_path.name} -> {out_npz.name}  |  Z×Y×X={shape[:3]}  |  "
           f"voxel µm=({vx_um:.3f},{vy_um:.3f},{vz_um:.3f})  |  map={ch_map}")
 
 
@@ -178,11 +629,29 @@ def discover_files(root: Path, include_tiff=False, recursive=False):
     return sorted(files)
 
 
+def partial_path(out_npz):
+    """Temporary name an NPZ is written under until it is complete."""
+    return out_npz.with_name(out_npz.name + ".part")
+
+
+def _convert_worker(task):
+    """
+    multiprocessing entry point for batch mode: run convert_one on one file and
+    return an error line instead of raising, so one bad file doesn't stop the batch.
+    """
+    p, out_npz, kwargs = task
+    try:
+        convert_one(p, out_npz, **kwargs)
+    except Exception as e:
+        return f"[ERR] {p.name}: {e}"
+    return None
+
+
 # ---------------------------- CLI ------------------------------------------------
 
 def main():
     ap = argparse.ArgumentParser(
-        description="Convert LSM (and optionally TIFF) into NPZ (r,g,b + meta.json) for the HTML volume viewer."
+        description="Convert LSM (and optionally TIFF) into NPZ (rgb + meta.json) for the HTML volume viewer."
     )
     ap.add_argument("input",
                     help="Path to a single file OR a folder to process.")
@@ -203,14 +672,34 @@ def main():
                          "Example: 2,0,1 → Red←Ch2, Green←Ch0, Blue←Ch1. "
                          "Each index should be in [0, C-1], where C is # of channels in the file.")
 
+    ap.add_argument("--normalize", action=argparse.BooleanOptionalAction, default=True,
+                    help="Per-slice 0.5–99.5th percentile normalization (default on). "
+                         "--no-normalize divides by the file's brightest raw value instead, keeping "
+                         "intensities comparable across slices and channels.")
+
+    ap.add_argument("--dtype", choices=("uint8", "float32"), default="uint8",
+                    help="Stored voxel type (default uint8: 1 byte/voxel, plenty for display). "
+                         "float32 keeps full precision at 4× the file size.")
+
+    ap.add_argument("--zlevel", type=int, default=1, choices=range(10), metavar="{0..9}",
+                    help="DEFLATE compression level for the NPZ (int 0–9; default 1). "
+                         "1 is several times faster than 6–9 for ~10%% larger files; 0 stores uncompressed.")
+
     ap.add_argument("--recursive", action="store_true",
                     help="Recurse into subfolders (only relevant when input is a folder).")
 
     ap.add_argument("--include-tiff", action="store_true",
                     help="Also include .tif/.tiff files (default processes only .lsm).")
 
+    ap.add_argument("--jobs", type=int, default=0,
+                    help="Files converted in parallel in batch mode (int ≥ 1; default 0 = one per CPU core). "
+                         "Each job holds a full stack in memory, so lower this for large stacks.")
+
     args = ap.parse_args()
 
+    if args.ds < 1:
+        raise SystemExit("--ds must be a positive integer, e.g. 6")
+
     # Parse and validate --map
     try:
         ch_map = tuple(int(x.strip()) for x in args.map.split(","))
@@ -233,16 +722,30 @@ def main():
             out_npz = out_path / (in_path.stem + ".npz")
         else:
             out_npz = out_path
-        convert_one(in_path, out_npz, ds=args.ds, sigma=args.sigma, ch_map=ch_map)
+        convert_one(in_path, out_npz, ds=args.ds, sigma=args.sigma, ch_map=ch_map,
+                    dtype=args.dtype, zlevel=args.zlevel, percentile_norm=args.normalize)
     else:
         # Batch mode
         out_path.mkdir(parents=True, exist_ok=True)
-        for p in files:
-            out_npz = out_path / (p.stem + ".npz")
-            try:
-                convert_one(p, out_npz, ds=args.ds, sigma=args.sigma, ch_map=ch_map)
-            except Exception as e:
-                print(f"[ERR] {p.name}: {e}")
+        cpus = os.cpu_count() or 1
+        jobs = max(1, min(args.jobs or cpus, len(files)))
+        kwargs = dict(ds=args.ds, sigma=args.sigma, ch_map=ch_map, threads=max(1, cpus // jobs),
+                      dtype=args.dtype, zlevel=args.zlevel, percentile_norm=args.normalize)
+        tasks = [(p, out_path / (p.stem + ".npz"), kwargs) for p in files]
+        # maxtasksperchild recycles workers to bound memory growth across many stacks.
+        # Leaving the with block terminates the pool, so Ctrl-C stops the batch at once.
+        pool = multiprocessing.Pool(processes=jobs, maxtasksperchild=4) if jobs > 1 else None
+        try:
+            with pool or nullcontext():
+                errors = pool.imap(_convert_worker, tasks) if pool else map(_convert_worker, tasks)
+                for err in errors:
+                    if err:
+                        print(err)
+        except BaseException:
+            # Terminated workers get no chance to remove their partial outputs
+            for _, out_npz, _ in tasks:
+                partial_path(out_npz).unlink(missing_ok=True)
+            raise
 
 
 if __name__ == "__main__":
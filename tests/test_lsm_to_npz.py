@@ -0,0 +1,76 @@
+"""
+The fused numba preprocessing kernel must produce what the NumPy path produces.
+Run from the repository root with `python -m pytest -q`.
+"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pytest.importorskip("numba")
+tifffile = pytest.importorskip("tifffile")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
+import lsm_to_npz  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def stack_path(tmp_path_factory):
+    """Synthetic 6×4×48×40 uint16 ZCYX stack: noisy blobs plus flat and empty slices."""
+    rng = np.random.default_rng(0)
+    Z, C, Y, X = 6, 4, 48, 40
+    yy, xx = np.mgrid[:Y, :X]
+    vol = rng.poisson(50, (Z, C, Y, X)).astype(np.float64)
+    for z in range(Z):
+        for c in range(C):
+            cy, cx = rng.uniform(0, Y), rng.uniform(0, X)
+            vol[z, c] += 2000 * np.exp(-((yy - cy) ** 2 + (xx - cx) ** 2) / 30.0)
+    vol[1] = 1000   # flat slice: background round-off must not be stretched
+    vol[4] = 0      # empty slice
+    vol = np.clip(vol, 0, 4095).astype(np.uint16)
+    path = tmp_path_factory.mktemp("stack") / "synthetic.tif"
+    tifffile.imwrite(str(path), vol, imagej=True, metadata={"axes": "ZCYX"})
+    return path
+
+
+def convert(stack_path, tmp_path, name, **kwargs):
+    out = tmp_path / name
+    lsm_to_npz.convert_one(stack_path, out, ch_map=(2, 0, 1), dtype="float32", **kwargs)
+    with np.load(out) as npz:
+        return npz["rgb"]
+
+
+@pytest.mark.parametrize("ds, sigma", [
+    (2, 6),     # pooling and blur
+    (3, 0),     # no background step
+    (1, 2),     # blur only
+    (4, 12),    # Gaussian radius (12) larger than the 12×10 downsampled slice
+])
+def test_fused_matches_numpy(stack_path, tmp_path, monkeypatch, ds, sigma):
+    fused_calls = []
+    kernel = lsm_to_npz._fused_preprocess
+
+    def counting_kernel(*args):
+        fused_calls.append(args[2:4])
+        return kernel(*args)
+
+    monkeypatch.setattr(lsm_to_npz, "_fused_preprocess", counting_kernel)
+    fused = convert(stack_path, tmp_path, "fused.npz", ds=ds, sigma=sigma)
+    assert fused_calls, "fused kernel was not used"
+
+    monkeypatch.setattr(lsm_to_npz, "_fused_preprocess", None)
+    reference = convert(stack_path, tmp_path, "numpy.npz", ds=ds, sigma=sigma)
+
+    assert fused.shape == reference.shape
+    np.testing.assert_allclose(fused, reference, rtol=0, atol=1e-4)
+    assert not fused[[1, 4]].any() and not reference[[1, 4]].any()
+
+
+@pytest.mark.parametrize("n", [1, 2, 3, 5, 10, 201, 1000])
+def test_percentile_pair_matches_numpy(n):
+    rng = np.random.default_rng(n)
+    for values in (rng.random(n), rng.integers(0, 4, n)):
+        values = values.astype(np.float32)
+        got = lsm_to_npz._percentile_pair(values.copy(), 0.5, 99.5)
+        np.testing.assert_allclose(got, np.percentile(values, [0.5, 99.5]), rtol=1e-6, atol=1e-7)